@@ -1,8 +1,14 @@
-import json
+import csv
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import ijson
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util import Retry
 import streamlit as st
 
 st.set_page_config(page_title="Woo Bulk Tracking Uploader", layout="wide")
@@ -44,11 +50,41 @@ if not site or not ck or not cs:
     st.error("Credentials are required to proceed.")
     st.stop()
 
-auth = HTTPBasicAuth(ck, cs)
+POOL_SIZE = 32
+
+class WooRetry(Retry):
+    # A 502/504 can arrive after WordPress already saved a POST, so POSTs only retry
+    # statuses where the request was never processed
+    POST_RETRY_STATUSES = (429, 503)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST" and status_code not in self.POST_RETRY_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+@st.cache_resource
+def get_session(ck: str, cs: str) -> requests.Session:
+    # One pooled keep-alive session per credential pair, reused across reruns
+    s = requests.Session()
+    # Transient 429/5xx are retried with backoff inside urllib3; once retries run out
+    # the last response is returned so the row is reported rather than raising.
+    # read=False: a timed-out POST may already be saved, so it is never replayed.
+    retry = WooRetry(total=5, read=False, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                     allowed_methods=frozenset(["POST", "PUT", "GET"]),
+                     respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.auth = HTTPBasicAuth(ck, cs)
+    # Bodies are sent pre-encoded as bytes, so the JSON content type is set here
+    s.headers.update({"Accept-Encoding": "gzip", "Content-Type": "application/json"})
+    return s
+
+session = get_session(ck, cs)
 
 # --- Upload payload: CSV / JSON / XLSX ---
 st.subheader("Upload payload as CSV or JSON")
-uploaded = st.file_uploader("Choose CSV/JSON/XLSX (max ~200MB)", type=["csv", "json", "xlsx"])
+uploaded = st.file_uploader("Choose CSV/JSON/JSONL/XLSX (max ~200MB)", type=["csv", "json", "jsonl", "xlsx"])
 # (file_uploader ref & limits)  :contentReference[oaicite:1]{index=1}
 
 sample_json = [
@@ -61,20 +97,65 @@ sample_json = [
     }
 ]
 with st.expander("See JSON schema"):
-    st.code(json.dumps(sample_json, indent=2), language="json")
+    st.code(orjson.dumps(sample_json, option=orjson.OPT_INDENT_2).decode(), language="json")
+
+PAYLOAD_COLUMNS = ["order_id", "tracking_provider", "tracking_number",
+                   "date_shipped", "status_shipped", "replace_tracking"]
+
+# Identifiers are read as text so type inference can't turn tracking numbers into floats
+CSV_DTYPES = {"order_id": "int64", "tracking_provider": "string",
+              "tracking_number": "string", "date_shipped": "string"}
+
+def read_csv(file) -> pd.DataFrame:
+    # Multi-threaded Arrow parser when available, pandas C engine otherwise.
+    # pandas' pyarrow engine only applies dtype after Arrow has inferred the columns,
+    # so the types go straight to Arrow's reader instead.
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+        column_types = {c: pa.int64() if t == "int64" else pa.string() for c, t in CSV_DTYPES.items()}
+        table = pa_csv.read_csv(file, convert_options=pa_csv.ConvertOptions(column_types=column_types))
+        table = table.select([c for c in table.column_names if c in PAYLOAD_COLUMNS])
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    except (ImportError, ValueError):
+        file.seek(0)
+        return pd.read_csv(file, usecols=lambda c: c in PAYLOAD_COLUMNS, dtype=CSV_DTYPES)
 
-def load_dataframe(file) -> pd.DataFrame:
-    name = file.name.lower()
+def read_xlsx(file) -> pd.DataFrame:
+    # Rust-backed calamine reader when available, openpyxl otherwise
+    usecols = lambda c: c in PAYLOAD_COLUMNS
+    try:
+        return pd.read_excel(file, engine="calamine", usecols=usecols)
+    except (ImportError, ValueError):
+        file.seek(0)
+        return pd.read_excel(file, engine="openpyxl", usecols=usecols)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_dataframe(raw: bytes, name: str) -> pd.DataFrame:
+    # Keyed on the upload's bytes, so reruns reuse the parsed frame
+    file = io.BytesIO(raw)
+    name = name.lower()
+    if name.endswith(".jsonl"):
+        # dtype=False keeps quoted tracking numbers as strings (no leading-zero/float loss)
+        chunks = list(pd.read_json(file, lines=True, chunksize=50_000, dtype=False))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks, ignore_index=True)
     if name.endswith(".json"):
-        data = json.load(io.TextIOWrapper(file, encoding="utf-8"))
+        # Stream top-level arrays row by row instead of holding the parsed document too
+        is_array = file.read(1024).lstrip().startswith(b"[")
+        file.seek(0)
+        if is_array:
+            return pd.DataFrame.from_records(ijson.items(file, "item", use_float=True))
+        data = orjson.loads(file.read())
         return pd.DataFrame(data)
     if name.endswith(".csv"):
-        return pd.read_csv(file)
+        return read_csv(file)
     if name.endswith(".xlsx"):
         try:
-            return pd.read_excel(file)
+            return read_xlsx(file)
         except Exception as e:
-            st.error(f"Excel read error. Install openpyxl. Details: {e}")
+            st.error(f"Excel read error. Install python-calamine or openpyxl. Details: {e}")
             return pd.DataFrame()
     return pd.DataFrame()
 
@@ -83,87 +164,236 @@ def validate_df(df: pd.DataFrame):
     missing = [c for c in required if c not in df.columns]
     return len(missing) == 0, missing
 
-def post_tracking(site_url: str, auth: HTTPBasicAuth, row: dict):
-    order_id = int(row["order_id"])
-    url = f"{site_url.rstrip('/')}/wp-json/wc-shipment-tracking/v3/orders/{order_id}/shipment-trackings"
-    payload = {
-        "tracking_provider": str(row["tracking_provider"]),
-        "tracking_number":  str(row["tracking_number"]),
-        "date_shipped":     str(row.get("date_shipped")) if row.get("date_shipped") else None,
-        "status_shipped":   int(row.get("status_shipped", 1)),
-        "replace_tracking": int(row.get("replace_tracking", 0))
-    }
-    payload = {k: v for k, v in payload.items() if v is not None}
-    r = requests.post(url, auth=auth, json=payload, timeout=30)
+def coerce_df(df: pd.DataFrame) -> pd.DataFrame:
+    # Cast whole columns once so the per-row hot path needs no int()/str()
+    df["order_id"] = df["order_id"].astype("int64")
+    df["tracking_provider"] = df["tracking_provider"].astype(str)
+    df["tracking_number"] = df["tracking_number"].astype(str)
+    df["status_shipped"] = df["status_shipped"].fillna(1).astype("int64")
+    df["replace_tracking"] = df["replace_tracking"].fillna(0).astype("int64")
+    if "date_shipped" in df.columns:
+        dates = df["date_shipped"]
+        # object dtype keeps None for blanks; pandas 3's str dtype would turn them into NaN
+        df["date_shipped"] = dates.astype(str).astype(object).where(dates.notna(), None)
+    return df
+
+def build_payloads(df: pd.DataFrame) -> list:
+    # Minimal tracking payloads, built in one pass over the coerced frame
+    has_date = "date_shipped" in df.columns
+    payloads = []
+    for t in df.itertuples(index=False):
+        p = {
+            "tracking_provider": t.tracking_provider,
+            "tracking_number":  t.tracking_number,
+            "status_shipped":   t.status_shipped,
+            "replace_tracking": t.replace_tracking
+        }
+        if has_date and pd.notna(t.date_shipped) and t.date_shipped:
+            p["date_shipped"] = t.date_shipped
+        payloads.append((t.order_id, p))
+    return payloads
+
+TRACKING_PATH = "/wp-json/wc-shipment-tracking/v3/orders/%d/shipment-trackings"
+
+def decode_body(raw: bytes):
     try:
-        data = r.json()
+        return orjson.loads(raw)
     except Exception:
-        data = {"text": r.text}
-    return r.status_code, data
+        return {"text": raw[:500].decode("utf-8", "replace")}
 
-def complete_order(site_url: str, auth: HTTPBasicAuth, order_id: int):
-    url = f"{site_url.rstrip('/')}/wp-json/wc/v3/orders/{order_id}"
-    payload = {"status": "completed"}
-    r = requests.put(url, auth=auth, json=payload, timeout=30)
+def post_tracking(session: requests.Session, tracking_url: str, order_id: int, payload: dict):
+    # Raw body is returned undecoded; see decode_body
+    r = session.post(tracking_url % order_id, data=orjson.dumps(payload), timeout=30)
+    return r.status_code, r.content
+
+BATCH_SIZE = 100  # Woo's orders/batch accepts at most 100 updates per request
+
+def fetch_orders(session: requests.Session, base: str, order_ids: list) -> dict:
+    # Maps order id -> (status, tracking numbers already saved by Shipment Tracking)
+    params = {"include": ",".join(map(str, order_ids)), "per_page": BATCH_SIZE, "_fields": "id,status,meta_data"}
     try:
-        data = r.json()
+        r = session.get(f"{base}/wp-json/wc/v3/orders", params=params, timeout=30)
+        data = orjson.loads(r.content)
     except Exception:
-        data = {"text": r.text}
-    return r.status_code, data
+        return {}
+    # On any failure nothing is skipped and every order is processed as before
+    if r.status_code != 200 or not isinstance(data, list):
+        return {}
+    orders = {}
+    for o in data:
+        if not isinstance(o, dict):
+            continue
+        numbers = set()
+        for m in o.get("meta_data") or []:
+            if isinstance(m, dict) and m.get("key") == "_wc_shipment_tracking_items" and isinstance(m.get("value"), list):
+                numbers.update(str(t.get("tracking_number")) for t in m["value"] if isinstance(t, dict))
+        orders[o.get("id")] = (o.get("status"), numbers)
+    return orders
+
+def complete_orders(session: requests.Session, base: str, order_ids: list) -> dict:
+    url = f"{base}/wp-json/wc/v3/orders/batch"
+    payload = {"update": [{"id": oid, "status": "completed"} for oid in order_ids]}
+    try:
+        r = session.post(url, data=orjson.dumps(payload), timeout=120)
+    except requests.RequestException as e:
+        return {oid: (None, {"error": str(e)}) for oid in order_ids}
+    data = decode_body(r.content)
+
+    updated = {}
+    if isinstance(data, dict):
+        updated = {o.get("id"): o for o in data.get("update", []) if isinstance(o, dict)}
+
+    results = {}
+    for oid in order_ids:
+        item = updated.get(oid)
+        if item is None and not 200 <= r.status_code < 300:
+            # Whole request failed: report the batch response
+            results[oid] = (r.status_code, data)
+        elif item is None:
+            # Accepted batch without this order: its status is unknown
+            results[oid] = (None, {"error": "order missing from batch response", "batch": data})
+        elif "error" in item:
+            results[oid] = ((item["error"].get("data") or {}).get("status", r.status_code), item)
+        else:
+            results[oid] = (r.status_code, item)
+    return results
+
+RESULT_COLUMNS = ["order_id", "skipped", "tracking_status", "tracking_ok", "complete_status",
+                  "complete_ok", "tracking_response", "complete_response"]
+PREVIEW_ROWS = 200
+
+def result_row(order_id: int, tracking_status=None, tracking_response=None, skipped: bool = False) -> dict:
+    return {
+        "order_id": order_id,
+        "skipped": skipped,
+        "tracking_status": tracking_status,
+        "tracking_ok": tracking_status in (200, 201),
+        "complete_status": None,
+        "complete_ok": False,
+        "tracking_response": {"skipped": True} if tracking_response is None else tracking_response,
+        "complete_response": {"skipped": True}
+    }
+
+def track_row(session: requests.Session, tracking_url: str, idx: int, order_id: int, payload: dict) -> tuple:
+    try:
+        t_status, t_data = post_tracking(session, tracking_url, order_id, payload)
+    except requests.RequestException as e:
+        # Record the failure for this row instead of aborting the whole run
+        t_status, t_data = None, {"error": str(e)}
+    return idx, result_row(order_id, t_status, t_data)
 
 if uploaded:
-    df = load_dataframe(uploaded)
+    df = load_dataframe(uploaded.getvalue(), uploaded.name)
     ok, missing = validate_df(df)
     if not ok:
         st.error(f"Missing required columns: {', '.join(missing)}")
         st.stop()
 
+    # One tracking call per order: duplicates would add the same tracking twice
+    before = len(df)
+    # Drop empty tracking first so a blank last row can't hide an earlier valid one
+    df = df[df["tracking_number"].notna() & df["tracking_number"].astype(str).str.strip().ne("")]
+    df = df.drop_duplicates(subset=["order_id"], keep="last")
+    df = df.reset_index(drop=True)
+    dropped = before - len(df)
+    if dropped:
+        st.info(f"Dropped {dropped} duplicate or empty-tracking rows")
+
     # Defaults for optional fields
     if "status_shipped" not in df.columns:
         df["status_shipped"] = 1
     if "replace_tracking" not in df.columns:
         df["replace_tracking"] = 0
+    df = coerce_df(df)
 
     st.subheader("Preview")
     st.dataframe(df.head(20), use_container_width=True)
 
     run = st.button("Run Bulk Update")
     if run:
-        results = []
         prog = st.progress(0)
         log = st.empty()
-        total = len(df)
+        base = site.rstrip("/")
+        tracking_url = base + TRACKING_PATH
+        payloads = build_payloads(df)
+        total = len(payloads)
+        # Each row has a fixed slot, so workers' results land without appends or locks
+        results = [None] * total
+        # Re-render at most every 1% of rows or 50ms, not once per order
+        update_every = max(1, total // 100)
+        last = time.monotonic()
 
-        for i, row in enumerate(df.to_dict(orient="records"), start=1):
-            oid = int(row["order_id"])
+        # Workers mostly wait on sockets; one worker per pooled keep-alive connection.
+        # UI updates stay on this thread, so no lock is needed around log/prog.
+        with ThreadPoolExecutor(max_workers=POOL_SIZE) as ex:
+            # 0) Skip completed orders that already carry this tracking number; completed
+            #    orders without it still get tracking but are not completed again
+            log.write("Checking existing orders…")
+            oids = [oid for oid, _ in payloads]
+            chunks = [oids[i:i + BATCH_SIZE] for i in range(0, len(oids), BATCH_SIZE)]
+            order_map = {}
+            for found in ex.map(lambda chunk: fetch_orders(session, base, chunk), chunks):
+                order_map.update(found)
+            pending = []
+            already_completed = set()
+            for idx, (oid, p) in enumerate(payloads):
+                status, numbers = order_map.get(oid, (None, set()))
+                if status == "completed":
+                    if p["tracking_number"] in numbers and not p["replace_tracking"]:
+                        results[idx] = result_row(oid, skipped=True)
+                        continue
+                    already_completed.add(oid)
+                pending.append(idx)
+            done = total - len(pending)
+            if done:
+                prog.progress(done / total)
 
             # 1) Add tracking
-            t_status, t_data = post_tracking(site, auth, row)
-            success_tracking = t_status in (200, 201)
-
-            # 2) Only complete if tracking succeeded
-            if success_tracking:
-                c_status, c_data = complete_order(site, auth, oid)
-                success_complete = c_status in (200, 201)
-            else:
-                c_status, c_data = None, {"skipped": True}
-                success_complete = False
-
-            results.append({
-                "order_id": oid,
-                "tracking_status": t_status,
-                "tracking_ok": success_tracking,
-                "complete_status": c_status,
-                "complete_ok": success_complete,
-                "tracking_response": t_data,
-                "complete_response": c_data
-            })
-
-            log.write(f"Order {oid} tracking {t_status} → complete {c_status}")
-            prog.progress(i / total)
+            futures = [ex.submit(track_row, session, tracking_url, idx, *payloads[idx]) for idx in pending]
+            for i, f in enumerate(as_completed(futures), start=done + 1):
+                idx, res = f.result()
+                results[idx] = res
+                if i == total or i % update_every == 0 or time.monotonic() - last > 0.05:
+                    prog.progress(i / total)
+                    log.write(f"Processed {i}/{total} (last order {res['order_id']} tracking {res['tracking_status']})")
+                    last = time.monotonic()
+
+            # 2) Only complete orders whose tracking succeeded, in batches
+            oids = []
+            for res in results:
+                if res["tracking_ok"] and res["order_id"] in already_completed:
+                    res["complete_response"] = {"skipped": True, "status": "completed"}
+                elif res["tracking_ok"]:
+                    oids.append(res["order_id"])
+            chunks = [oids[i:i + BATCH_SIZE] for i in range(0, len(oids), BATCH_SIZE)]
+            log.write(f"Completing {len(oids)} orders in {len(chunks)} batch request(s)…")
+            completed = {}
+            for batch in ex.map(lambda chunk: complete_orders(session, base, chunk), chunks):
+                completed.update(batch)
+
+        # Decode tracking bodies only once the network phase is over
+        tracked = [res for res in results if isinstance(res["tracking_response"], bytes)]
+        with ThreadPoolExecutor(max_workers=4) as dec:
+            bodies = dec.map(decode_body, [res["tracking_response"] for res in tracked])
+            for res, data in zip(tracked, bodies):
+                res["tracking_response"] = data
+
+        # Write the CSV row by row instead of materializing a results DataFrame
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        for res in results:
+            if res["order_id"] in completed:
+                c_status, c_data = completed[res["order_id"]]
+                res["complete_status"] = c_status
+                res["complete_ok"] = c_status in (200, 201)
+                res["complete_response"] = c_data
+            res["tracking_response"] = orjson.dumps(res["tracking_response"]).decode()
+            res["complete_response"] = orjson.dumps(res["complete_response"]).decode()
+            writer.writerow(res)
 
         st.success("Done")
-        out = pd.DataFrame(results)
-        st.dataframe(out, use_container_width=True)
-        csv = out.to_csv(index=False).encode("utf-8")
-        st.download_button("Download results CSV", data=csv, file_name="tracking_results.csv", mime="text/csv")
+        st.dataframe(pd.DataFrame(results[:PREVIEW_ROWS]), use_container_width=True)
+        if total > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS} of {total} results. Download the CSV for all of them.")
+        st.download_button("Download results CSV", data=buf.getvalue().encode("utf-8"), file_name="tracking_results.csv", mime="text/csv")